@@ -5,28 +5,113 @@ date: 2024-12-04
 version: 1.0
 license: MIT
 description: A pipeline that tracks LLM interactions using Langfuse for observability and analytics
-requirements: pydantic, langfuse, requests
+requirements: pydantic, langfuse, requests, orjson
 """
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Iterable, Tuple
 from pydantic import BaseModel
+import asyncio
+import io
 import json
 import logging
+import threading
 import time
-import uuid
-from datetime import datetime
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (handlers are left to the host process)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
+# Prefer orjson for parsing request bodies, fall back to the stdlib
 try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import httpx
     from langfuse import Langfuse
     LANGFUSE_AVAILABLE = True
 except ImportError:
     logger.warning("Langfuse not available. Install with: pip install langfuse")
     LANGFUSE_AVAILABLE = False
 
+# Request fields reported as model parameters
+_PARAM_KEYS = frozenset({"temperature", "top_p", "max_tokens", "frequency_penalty", "presence_penalty"})
+
+
+# Response fields that are small enough to report when no content field is found
+_SAFE_OUTPUT_KEYS = ("id", "object", "model", "done_reason", "finish_reason")
+
+
+def _openai_output(body: dict) -> Any:
+    """Content of an OpenAI chat completion response"""
+    return body["choices"][0]["message"].get("content", "")
+
+
+def _openwebui_output(body: dict) -> Any:
+    """Content of an Open WebUI outlet body: the response is the last message"""
+    return body["messages"][-1].get("content", "")
+
+
+def _ollama_output(body: dict) -> Any:
+    """Content of an Ollama chat response"""
+    return body["message"].get("content", "")
+
+
+_OUTPUT_EXTRACTORS: Dict[str, Callable[[dict], Any]] = {
+    "openai": _openai_output,
+    "openwebui": _openwebui_output,
+    "ollama": _ollama_output,
+}
+
+
+# Hash used to anonymize user IDs. Note that the IDs it produces differ between
+# blake3 and the sha256 fallback, so switching changes the reported user IDs.
+try:
+    from blake3 import blake3 as _hash
+except ImportError:
+    from hashlib import sha256 as _hash
+
+
+@lru_cache(maxsize=4096)
+def _anonymize_user_id(user_id: str) -> str:
+    """Create anonymous hash of a user ID (cached per user)"""
+    return _hash(user_id.encode()).digest()[:8].hex()
+
+
+def _bounded_join(pieces: Iterable[str], limit: int) -> Tuple[str, int]:
+    """Concatenate pieces up to limit characters (marked with "..." when cut) and return the full length"""
+    buf = io.StringIO()
+    remaining = limit
+    total_len = 0
+    for piece in pieces:
+        total_len += len(piece)
+        if remaining < 0:
+            # Already truncated, only keep counting
+            continue
+        if len(piece) > remaining:
+            buf.write(piece[:remaining])
+            buf.write("...")
+            remaining = -1
+        else:
+            buf.write(piece)
+            remaining -= len(piece)
+    return buf.getvalue(), total_len
+
+
+@dataclass(slots=True)
+class _TraceState:
+    """Langfuse objects and timing for one in-flight conversation turn"""
+    trace: Any
+    generation: Any
+    input_tokens: Optional[int]
+    start_ns: int
+
 class Pipeline:
     class Valves(BaseModel):
         pipelines: List[str] = []
@@ -58,6 +143,12 @@ class Pipeline:
         anonymize_user_data: bool = False
         exclude_system_messages: bool = False
         max_content_length: int = 10000  # Truncate long content
+        response_format: str = "auto"  # "auto", "openai", "openwebui" or "ollama"
+
+        # Background Processing
+        max_queue_size: int = 10000  # Oldest events are dropped when the queue is full
+        langfuse_flush_at: int = 20  # Langfuse SDK sends a batch after this many events
+        langfuse_flush_interval: float = 5.0  # Langfuse SDK sends a batch at least this often (seconds)
         
         # Cost Tracking (tokens per dollar - approximate)
         cost_per_input_token: float = 0.000001  # $1 per 1M tokens
@@ -72,221 +163,344 @@ class Pipeline:
             }
         )
         self.langfuse = None
-        self.active_traces = {}  # Store active traces by conversation ID
-        self.start_times = {}  # Track request start times
-        logger.info(f"Initialized {self.name} pipeline")
+        self._http = None  # Pooled HTTP client handed to the Langfuse SDK
+        self._track_enabled = False  # See _refresh_tracking_state()
+        self._output_extractor: Optional[Callable[[dict], Any]] = None  # Resolved on first outlet
+        self._trace_meta_template = {"pipeline": self.name, "user_agent": "NumberOne_OWU"}
+        self._active: Dict[str, _TraceState] = {}  # Active traces by conversation ID (worker thread only)
+        self.generated_conversation_ids = {}  # Generated conversation IDs by user, until their outlet
+        self._events = deque(maxlen=self.valves.max_queue_size)  # Pending tracking events
+        self._events_ready = threading.Event()
+        self._stopping = threading.Event()
+        self._worker = None
+        self._dropped_events = 0
+        logger.info("Initialized %s pipeline", self.name)
 
     async def on_startup(self):
-        logger.info(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         if LANGFUSE_AVAILABLE and self.valves.enable_tracking:
             await self._initialize_langfuse()
+        if self.langfuse:
+            self._start_worker()
+
+    async def on_valves_updated(self):
+        logger.info("on_valves_updated:%s", __name__)
+        if LANGFUSE_AVAILABLE and self.valves.enable_tracking and not self.langfuse:
+            await self._initialize_langfuse()
+            if self.langfuse:
+                self._start_worker()
+        self._refresh_tracking_state()
+        self._output_extractor = None
 
     async def on_shutdown(self):
-        logger.info(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
+        await self._stop_worker()
         if self.langfuse:
             try:
-                self.langfuse.flush()
+                # shutdown() waits for in-flight batches, unlike flush()
+                self.langfuse.shutdown()
                 logger.info("Langfuse data flushed successfully")
             except Exception as e:
-                logger.error(f"Error flushing Langfuse data: {e}")
+                logger.error("Error flushing Langfuse data: %s", e)
+        if self._http:
+            self._http.close()
+            self._http = None
 
     async def _initialize_langfuse(self):
         """Initialize Langfuse client"""
         try:
             if self.valves.langfuse_secret_key and self.valves.langfuse_public_key:
+                # Keep connections to Langfuse alive between batches
+                self._http = httpx.Client(
+                    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60)
+                )
                 self.langfuse = Langfuse(
                     secret_key=self.valves.langfuse_secret_key,
                     public_key=self.valves.langfuse_public_key,
-                    host=self.valves.langfuse_host
+                    host=self.valves.langfuse_host,
+                    flush_at=self.valves.langfuse_flush_at,
+                    flush_interval=self.valves.langfuse_flush_interval,
+                    httpx_client=self._http
                 )
                 logger.info("Langfuse client initialized successfully")
             else:
                 logger.warning("Langfuse API keys not configured")
         except Exception as e:
-            logger.error(f"Failed to initialize Langfuse: {e}")
+            logger.error("Failed to initialize Langfuse: %s", e)
+        self._refresh_tracking_state()
+
+    def _refresh_tracking_state(self):
+        """Recompute whether to track and bind inlet/outlet to match; call whenever valves or the client change"""
+        self._track_enabled = (
+            LANGFUSE_AVAILABLE and 
+            self.valves.enable_tracking and 
+            self.langfuse is not None
+        )
+
+        # Bind the specialized handlers so requests don't re-check the valves
+        if self._track_enabled:
+            self.inlet = self._track_inlet
+            self.outlet = self._track_outlet
+        else:
+            self.inlet = self._passthrough_inlet
+            self.outlet = self._passthrough_outlet
+
+    def _start_worker(self):
+        """Start the background thread that performs all Langfuse SDK calls"""
+        if self._worker and self._worker.is_alive():
+            return
+
+        self._events = deque(self._events, maxlen=self.valves.max_queue_size)
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._drain, name="langfuse-tracking", daemon=True)
+        self._worker.start()
+
+    async def _stop_worker(self):
+        """Stop the background thread after it has processed queued events"""
+        if not self._worker:
+            return
+
+        self._stopping.set()
+        self._events_ready.set()
+        await asyncio.to_thread(self._worker.join, 10)
+        self._worker = None
+
+    def _enqueue(self, event: tuple):
+        """Queue a tracking event, dropping the oldest one when full"""
+        if len(self._events) == self._events.maxlen:
+            self._dropped_events += 1
+        self._events.append(event)
+        self._events_ready.set()
+
+    def _drain(self):
+        """Worker loop: turn queued events into Langfuse traces (the SDK batches and sends them)"""
+        reported_drops = 0
+
+        while True:
+            self._events_ready.wait()
+            self._events_ready.clear()
+
+            while self._events:
+                try:
+                    event = self._events.popleft()
+                except IndexError:
+                    break
+                try:
+                    self._process_event(event)
+                except Exception as e:
+                    logger.error("Error processing tracking event: %s", e)
+
+            if self._dropped_events != reported_drops:
+                logger.warning("Tracking queue full, dropped %d events", self._dropped_events - reported_drops)
+                reported_drops = self._dropped_events
+
+            if self._stopping.is_set() and not self._events:
+                return
+
+    def _process_event(self, event: tuple):
+        """Perform the Langfuse SDK calls for a single queued event"""
+        kind = event[0]
+        if kind == "inlet":
+            _, conversation_id, user_id, snapshot, start_ns = event
+
+            # Create or get trace
+            trace = self._create_or_get_trace(conversation_id, user_id)
+
+            # Create generation span
+            if trace:
+                generation, input_tokens = self._create_generation(trace, snapshot, user_id)
+                self._active[conversation_id] = _TraceState(trace, generation, input_tokens, start_ns)
+        elif kind == "outlet":
+            _, conversation_id, output_content, end_ns, end_time = event
+            self._update_generation(conversation_id, output_content, end_ns, end_time)
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        """Track incoming requests"""
-        if not self._should_track():
-            return body
+        """Track incoming requests (rebound per instance by _refresh_tracking_state)"""
+        return await self._passthrough_inlet(body, user)
+
+    async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Track outgoing responses (rebound per instance by _refresh_tracking_state)"""
+        return await self._passthrough_outlet(body, user)
 
+    async def _passthrough_inlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Inlet used while tracking is disabled"""
+        return body
+
+    async def _passthrough_outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Outlet used while tracking is disabled"""
+        return body
+
+    async def _track_inlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        """Track incoming requests"""
         try:
             # Parse body if it's a string
             if isinstance(body, str):
-                body = json.loads(body)
+                body = _json_loads(body)
 
             # Generate or get conversation ID
-            conversation_id = self._get_conversation_id(body, user)
+            user_id = self._get_user_id(user)
+            conversation_id = self._get_conversation_id(body, user_id)
             
             # Record start time
-            self.start_times[conversation_id] = time.time()
-            
-            # Create or get trace
-            trace = await self._create_or_get_trace(conversation_id, user)
-            
-            # Create generation span
-            if trace:
-                generation = await self._create_generation(trace, body, user)
-                self.active_traces[conversation_id] = {
-                    "trace": trace,
-                    "generation": generation,
-                    "start_time": time.time()
-                }
+            start_ns = time.perf_counter_ns()
+            start_time = datetime.now(timezone.utc)
+
+            # Keep only what the worker needs: the truncated input, not the messages themselves
+            messages = body.get("messages", [])
+            input_content, input_length = self._measure_and_extract(messages)
+            snapshot = {
+                "model": body.get("model", "unknown"),
+                "input": input_content,
+                "input_length": input_length,
+                "message_count": len(messages),
+                "model_parameters": self._extract_model_parameters(body),
+                "start_time": start_time,
+            }
+            self._enqueue(("inlet", conversation_id, user_id, snapshot, start_ns))
 
-            logger.info(f"Started tracking for conversation: {conversation_id}")
+            logger.info("Started tracking for conversation: %s", conversation_id)
 
         except Exception as e:
-            logger.error(f"Error in inlet tracking: {e}")
+            logger.error("Error in inlet tracking: %s", e)
 
         return body
 
-    async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+    async def _track_outlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Track outgoing responses"""
-        if not self._should_track():
-            return body
-
         try:
             # Parse body if it's a string
             if isinstance(body, str):
-                body = json.loads(body)
+                body = _json_loads(body)
+
+            # Get conversation ID, matching the one used by inlet
+            conversation_id = self._get_outlet_conversation_id(body, self._get_user_id(user))
+            if not conversation_id:
+                return body
+            end_ns = time.perf_counter_ns()
+            end_time = datetime.now(timezone.utc)
 
-            # Get conversation ID
-            conversation_id = self._get_conversation_id(body, user)
-            
             # Update generation with response
-            if conversation_id in self.active_traces:
-                await self._update_generation(conversation_id, body)
-                
-            logger.info(f"Completed tracking for conversation: {conversation_id}")
+            self._enqueue(("outlet", conversation_id, self._extract_output_content(body), end_ns, end_time))
+
+            logger.info("Completed tracking for conversation: %s", conversation_id)
 
         except Exception as e:
-            logger.error(f"Error in outlet tracking: {e}")
+            logger.error("Error in outlet tracking: %s", e)
 
         return body
 
-    def _should_track(self) -> bool:
-        """Check if tracking should be enabled"""
-        return (
-            LANGFUSE_AVAILABLE and 
-            self.valves.enable_tracking and 
-            self.langfuse is not None
-        )
-
-    def _get_conversation_id(self, body: dict, user: Optional[dict] = None) -> str:
+    def _get_conversation_id(self, body: dict, user_id: str) -> str:
         """Extract or generate conversation ID"""
         # Try to get from body
         conv_id = body.get("conversation_id") or body.get("chat_id")
         
         if not conv_id:
-            # Generate based on user and timestamp
-            user_id = self._get_user_id(user)
+            # Generate based on user and timestamp, remembered so outlet can find it
             conv_id = f"{user_id}_{int(time.time())}"
+            self.generated_conversation_ids[user_id] = conv_id
         
         return str(conv_id)
 
+    def _get_outlet_conversation_id(self, body: dict, user_id: str) -> Optional[str]:
+        """Extract conversation ID for a response, falling back to the one generated by inlet"""
+        conv_id = body.get("conversation_id") or body.get("chat_id")
+        if conv_id:
+            return str(conv_id)
+        return self.generated_conversation_ids.pop(user_id, None)
+
     def _get_user_id(self, user: Optional[dict] = None) -> str:
         """Extract user ID with privacy considerations"""
         if not user:
             return "anonymous"
         
         user_id = user.get("id") or user.get("email") or user.get("username")
-        
-        if self.valves.anonymize_user_data and user_id:
-            # Create anonymous hash
-            import hashlib
-            user_id = hashlib.sha256(str(user_id).encode()).hexdigest()[:16]
-        
-        return user_id or "anonymous"
+        if not user_id:
+            return "anonymous"
+
+        if self.valves.anonymize_user_data:
+            return _anonymize_user_id(str(user_id))
+        return user_id
 
-    async def _create_or_get_trace(self, conversation_id: str, user: Optional[dict] = None):
+    def _create_or_get_trace(self, conversation_id: str, user_id: str):
         """Create or retrieve existing trace"""
         if not self.langfuse:
             return None
 
         try:
-            user_id = self._get_user_id(user)
-            
+            metadata = self._trace_meta_template.copy()
+            metadata["timestamp"] = time.time_ns()
+
             trace = self.langfuse.trace(
                 id=conversation_id,
                 name=f"Conversation_{conversation_id}",
                 user_id=user_id,
-                metadata={
-                    "pipeline": self.name,
-                    "timestamp": datetime.now().isoformat(),
-                    "user_agent": "NumberOne_OWU"
-                }
+                metadata=metadata
             )
             
             return trace
 
         except Exception as e:
-            logger.error(f"Error creating trace: {e}")
+            logger.error("Error creating trace: %s", e)
             return None
 
-    async def _create_generation(self, trace, body: dict, user: Optional[dict] = None):
-        """Create generation span for LLM interaction"""
+    def _create_generation(self, trace, snapshot: dict, user_id: str):
+        """Create generation span for LLM interaction, returning it with its input token count"""
         if not trace:
-            return None
+            return None, None
 
         try:
-            messages = body.get("messages", [])
-            model = body.get("model", "unknown")
+            model = snapshot["model"]
             
-            # Extract input content
-            input_content = self._extract_input_content(messages)
-            
-            # Count input tokens (approximate)
-            input_tokens = self._estimate_tokens(input_content) if self.valves.track_input_tokens else None
+            # Count input tokens (approximate, from the untruncated length)
+            input_tokens = (
+                self._estimate_tokens_for_length(snapshot["input_length"]) if self.valves.track_input_tokens else None
+            )
             
             generation = trace.generation(
                 name=f"LLM_Generation_{model}",
                 model=model,
-                input=input_content,
+                input=snapshot["input"],
+                start_time=snapshot["start_time"],
                 metadata={
-                    "model_parameters": self._extract_model_parameters(body),
-                    "message_count": len(messages),
-                    "user_id": self._get_user_id(user)
+                    "model_parameters": snapshot["model_parameters"],
+                    "message_count": snapshot["message_count"],
+                    "user_id": user_id
                 },
                 usage={
                     "input": input_tokens
                 } if input_tokens else None
             )
             
-            return generation
+            return generation, input_tokens
 
         except Exception as e:
-            logger.error(f"Error creating generation: {e}")
-            return None
+            logger.error("Error creating generation: %s", e)
+            return None, None
 
-    async def _update_generation(self, conversation_id: str, body: dict):
+    def _update_generation(self, conversation_id: str, output_content: str, end_ns: int, end_time: datetime):
         """Update generation with response data"""
-        if conversation_id not in self.active_traces:
+        state = self._active.pop(conversation_id, None)
+        if state is None:
             return
 
         try:
-            trace_data = self.active_traces[conversation_id]
-            generation = trace_data.get("generation")
-            start_time = trace_data.get("start_time", time.time())
-            
+            generation = state.generation
             if not generation:
                 return
 
-            # Extract response content
-            output_content = self._extract_output_content(body)
-            
             # Calculate metrics
-            end_time = time.time()
-            response_time = end_time - start_time
+            response_time_ms = (end_ns - state.start_ns) / 1_000_000
             
             # Count output tokens
             output_tokens = self._estimate_tokens(output_content) if self.valves.track_output_tokens else None
-            input_tokens = generation.input_usage.get("input", 0) if hasattr(generation, 'input_usage') else 0
+            input_tokens = state.input_tokens or 0
             
             # Calculate cost
             cost = self._calculate_cost(input_tokens, output_tokens) if self.valves.enable_cost_tracking else None
             
-            # Update generation
+            # End with the outlet's time, so queueing on the worker doesn't skew latency
             generation.end(
+                end_time=end_time,
                 output=output_content,
                 usage={
                     "input": input_tokens,
@@ -294,77 +508,85 @@ class Pipeline:
                     "total": (input_tokens or 0) + (output_tokens or 0)
                 } if self.valves.track_input_tokens or self.valves.track_output_tokens else None,
                 metadata={
-                    "response_time_ms": response_time * 1000,
+                    "response_time_ms": response_time_ms,
                     "cost_usd": cost,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": time.time_ns()
                 }
             )
-            
-            # Clean up
-            del self.active_traces[conversation_id]
-            if conversation_id in self.start_times:
-                del self.start_times[conversation_id]
 
         except Exception as e:
-            logger.error(f"Error updating generation: {e}")
-
-    def _extract_input_content(self, messages: List[dict]) -> str:
-        """Extract input content from messages"""
-        if self.valves.exclude_system_messages:
-            messages = [msg for msg in messages if msg.get("role") != "system"]
-        
-        content_parts = []
-        for msg in messages:
-            role = msg.get("role", "unknown")
-            content = msg.get("content", "")
-            content_parts.append(f"{role}: {content}")
-        
-        full_content = "\n".join(content_parts)
-        
-        # Truncate if too long
-        if len(full_content) > self.valves.max_content_length:
-            full_content = full_content[:self.valves.max_content_length] + "..."
-        
-        return full_content
+            logger.error("Error updating generation: %s", e)
+
+    def _measure_and_extract(self, messages: List[dict]) -> Tuple[str, int]:
+        """Extract truncated input content from messages along with its untruncated length"""
+        exclude_system = self.valves.exclude_system_messages
+
+        def pieces():
+            separator = ""
+            for msg in messages:
+                role = msg.get("role", "unknown")
+                if exclude_system and role == "system":
+                    continue
+                content = msg.get("content", "")
+                yield separator
+                yield role
+                yield ": "
+                yield content if isinstance(content, str) else str(content)
+                separator = "\n"
+
+        return _bounded_join(pieces(), self.valves.max_content_length)
 
     def _extract_output_content(self, body: dict) -> str:
         """Extract output content from response"""
-        # Handle different response formats
-        if "choices" in body:
-            # OpenAI format
-            choices = body["choices"]
-            if choices and "message" in choices[0]:
-                content = choices[0]["message"].get("content", "")
-            else:
-                content = str(body)
-        else:
-            # Other formats
-            content = str(body)
-        
+        # The response format is resolved once and reused; only known fields are read
+        extractor = self._output_extractor
+        if extractor is None:
+            extractor = _OUTPUT_EXTRACTORS.get(self.valves.response_format) or self._detect_output_extractor(body)
+            self._output_extractor = extractor
+
+        content = None
+        if extractor:
+            try:
+                content = extractor(body) or ""
+            except (KeyError, IndexError, TypeError, AttributeError):
+                # Response shape changed, detect it again on the next call
+                self._output_extractor = None
+
+        if content is None:
+            content = json.dumps(
+                {key: body[key] for key in _SAFE_OUTPUT_KEYS if key in body}, default=str
+            )[:256]
+        elif not isinstance(content, str):
+            content = str(content)
+
         # Truncate if too long
-        if len(content) > self.valves.max_content_length:
-            content = content[:self.valves.max_content_length] + "..."
-        
-        return content
+        return _bounded_join((content,), self.valves.max_content_length)[0]
+
+    def _detect_output_extractor(self, body: dict) -> Optional[Callable[[dict], Any]]:
+        """Pick the content extractor matching the shape of a response body"""
+        if "choices" in body:
+            return _openai_output
+        if "messages" in body:
+            return _openwebui_output
+        if "message" in body:
+            return _ollama_output
+        return None
 
     def _extract_model_parameters(self, body: dict) -> dict:
         """Extract model parameters from request"""
         if not self.valves.track_model_parameters:
             return {}
         
-        params = {}
-        param_keys = ["temperature", "top_p", "max_tokens", "frequency_penalty", "presence_penalty"]
-        
-        for key in param_keys:
-            if key in body:
-                params[key] = body[key]
-        
-        return params
+        return {key: body[key] for key in _PARAM_KEYS & body.keys()}
 
     def _estimate_tokens(self, text: str) -> int:
         """Estimate token count (rough approximation)"""
+        return self._estimate_tokens_for_length(len(text))
+
+    def _estimate_tokens_for_length(self, length: int) -> int:
+        """Estimate token count from a character count"""
         # Very rough estimation: ~4 characters per token
-        return len(text) // 4
+        return length // 4
 
     def _calculate_cost(self, input_tokens: Optional[int], output_tokens: Optional[int]) -> Optional[float]:
         """Calculate estimated cost"""
@@ -5,19 +5,35 @@ date: 2024-12-04
 version: 2.0
 license: MIT
 description: A filter that processes user messages and stores them as long term memory by utilizing the mem0 framework together with qdrant and ollama
-requirements: pydantic, ollama, mem0ai
+requirements: pydantic, ollama, mem0ai, orjson
 """
 
 from typing import List, Optional
 from pydantic import BaseModel
 import json
 from mem0 import Memory
+from collections import OrderedDict, deque
+import asyncio
+import hashlib
+import queue
 import threading
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (handlers are left to the host process)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Prefer orjson for parsing request bodies, fall back to the stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Memory instances shared by every pipeline instance, keyed by their mem0 config.
+# Building one opens Qdrant and Ollama clients, so it happens once per config.
+_MEMORY_INSTANCES = {}
+_MEMORY_INIT_LOCK = threading.Lock()
 
 class Pipeline:
     class Valves(BaseModel):
@@ -26,6 +42,8 @@ class Pipeline:
 
         # Memory Configuration
         store_cycles: int = 3  # Number of messages from the user before the data is processed and added to the memory
+        max_memory_batch: int = 8  # Max queued store cycles combined into a single memory.add call
+        max_message_length: int = 4000  # User messages are truncated to this many characters before being kept for storage
         mem_zero_user: str = "bailey"  # Memories belongs to this user, only used by mem0 for internal organization of memories
         
         # Enable/disable memory features
@@ -52,52 +70,82 @@ class Pipeline:
         # Memory retrieval settings
         max_memories_retrieved: int = 3
         memory_relevance_threshold: float = 0.7
+        search_cache_size: int = 512  # Recent (user, message) search results kept in memory, 0 disables
         memory_context_template: str = "This is your inner voice talking, you remember this about the person you're chatting with: {memory}"
 
     def __init__(self):
         self.type = "filter"
         self.name = "Memory Filter"
-        self.user_messages = []
-        self.thread = None
+        self._mem_q = queue.Queue(maxsize=256)  # Pending (messages, user_id) memory writes
+        self._mem_worker = None
+        self._search_cache = OrderedDict()  # (user_id, message digest) -> search results, LRU order
+        self._search_cache_lock = threading.Lock()
+        self._store_versions = {}  # user_id -> completed stores, so searches racing a store aren't cached
         self.m = None  # Initialize lazily
         self.valves = self.Valves(
             **{
                 "pipelines": ["*"],  # Connect to all pipelines
             }
         )
-        logger.info(f"Initialized {self.name} pipeline")
+        self.user_messages = deque(maxlen=self.valves.store_cycles)  # Oldest messages are evicted first
+        logger.info("Initialized %s pipeline", self.name)
 
     async def on_startup(self):
-        logger.info(f"on_startup:{__name__}")
-        # Test memory connection on startup
+        logger.info("on_startup:%s", __name__)
+        # Create the memory instance up front, off the event loop
         try:
-            memory = self.get_memory()
+            await asyncio.to_thread(self.get_memory)
             logger.info("Memory system initialized successfully")
         except Exception as e:
-            logger.error(f"Failed to initialize memory system: {e}")
+            logger.error("Failed to initialize memory system: %s", e)
+        self._start_mem_worker()
 
     async def on_shutdown(self):
-        logger.info(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
         # Wait for any pending memory operations
-        if self.thread and self.thread.is_alive():
+        if self._mem_worker and self._mem_worker.is_alive():
             logger.info("Waiting for memory operations to complete...")
-            self.thread.join(timeout=10)
+            try:
+                # Sentinel: stop after draining; wait off the event loop
+                await asyncio.to_thread(self._mem_q.put, None, True, 10)
+            except queue.Full:
+                logger.warning("Memory queue still full, pending memories may be lost")
+            await asyncio.to_thread(self._mem_worker.join, 10)
+        self._mem_worker = None
+
+    def _memory_logging(self) -> bool:
+        """Whether memory activity should be logged (checked before formatting anything)"""
+        return self.valves.enable_memory_logging and logger.isEnabledFor(logging.INFO)
+
+    def _start_mem_worker(self):
+        """Start the long-lived thread that performs memory writes"""
+        if self._mem_worker and self._mem_worker.is_alive():
+            return
+        self._mem_worker = threading.Thread(target=self._mem_loop, name="mem0-store", daemon=True)
+        self._mem_worker.start()
 
     def get_memory(self):
-        """Lazy initialization of memory instance"""
+        """Return the shared memory instance for the current configuration, creating it once"""
         if self.m is None:
-            try:
-                self.m = self.init_mem_zero()
-                logger.info("Memory instance created successfully")
-            except Exception as e:
-                logger.error(f"Failed to create memory instance: {e}")
-                raise
+            config = self.mem_zero_config()
+            key = json.dumps(config, sort_keys=True)
+            with _MEMORY_INIT_LOCK:
+                memory = _MEMORY_INSTANCES.get(key)
+                if memory is None:
+                    try:
+                        memory = self.init_mem_zero(config)
+                        logger.info("Memory instance created successfully")
+                    except Exception as e:
+                        logger.error("Failed to create memory instance: %s", e)
+                        raise
+                    _MEMORY_INSTANCES[key] = memory
+            self.m = memory
         return self.m
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Process incoming messages and add memory context"""
-        if self.valves.enable_memory_logging:
-            logger.info(f"Processing message through {__name__}")
+        if self._memory_logging():
+            logger.info("Processing message through %s", __name__)
 
         # Use configured user or fallback to valve setting
         user_id = self.valves.mem_zero_user
@@ -108,17 +156,18 @@ class Pipeline:
 
         # Parse body if it's a string
         if isinstance(body, str):
-            body = json.loads(body)
+            body = _json_loads(body)
 
-        all_messages = body.get("messages", [])
-        if not all_messages:
+        all_messages = body.get("messages") or ()
+        last_message = all_messages[-1].get("content") if all_messages else None
+        if not last_message:
             return body
-
-        last_message = all_messages[-1].get("content", "")
         
         # Store user messages for memory creation
         if self.valves.enable_memory_storage:
-            self.user_messages.append(last_message)
+            if self.user_messages.maxlen != store_cycles:
+                self.user_messages = deque(self.user_messages, maxlen=store_cycles)
+            self.user_messages.append(last_message[:self.valves.max_message_length])
 
             # Check if we should store memories
             if len(self.user_messages) >= store_cycles:
@@ -128,56 +177,73 @@ class Pipeline:
         if self.valves.enable_memory_retrieval:
             await self._add_memory_context(all_messages, last_message, user_id)
 
-        if self.valves.enable_memory_logging:
+        if self._memory_logging():
             logger.info("Message processing completed")
 
         return body
 
     async def _store_memories(self, user_id: str):
         """Store accumulated messages as memories"""
+        # Hand the messages to the memory worker, which joins them into one text;
+        # never block the request
+        messages = tuple(self.user_messages)
+        self.user_messages = deque(maxlen=self.valves.store_cycles)  # Start a fresh cycle
         try:
-            # Combine messages into a single text
-            message_text = " ".join(self.user_messages)
-            
-            # Wait for any previous memory operation to complete
-            if self.thread and self.thread.is_alive():
-                logger.info("Waiting for previous memory operation to complete")
-                self.thread.join(timeout=5)
-
-            # Start memory storage in background thread
-            memory = self.get_memory()
-            self.thread = threading.Thread(
-                target=self._store_memory_thread,
-                args=(memory, message_text, user_id)
-            )
-
-            if self.valves.enable_memory_logging:
-                logger.info(f"Storing memory for user {user_id}: {message_text[:100]}...")
-
-            self.thread.start()
-            self.user_messages.clear()
-
+            self._start_mem_worker()
+            self._mem_q.put_nowait((messages, user_id))
+        except queue.Full:
+            logger.warning("Memory queue full, dropping pending memories")
         except Exception as e:
-            logger.error(f"Failed to store memories: {e}")
-            self.user_messages.clear()  # Clear to prevent accumulation
-
-    def _store_memory_thread(self, memory: Memory, text: str, user_id: str):
-        """Thread function for storing memory"""
+            logger.error("Failed to store memories: %s", e)
+
+    def _mem_loop(self):
+        """Worker loop: batch queued memory writes into one memory.add call per user"""
+        while True:
+            item = self._mem_q.get()
+            if item is None:
+                return
+
+            # Pick up whatever else is already waiting, up to the batch size
+            batch = [item]
+            stop = False
+            while len(batch) < self.valves.max_memory_batch:
+                try:
+                    item = self._mem_q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            texts_by_user = {}
+            for messages, user_id in batch:
+                texts_by_user.setdefault(user_id, []).extend(messages)
+
+            for user_id, texts in texts_by_user.items():
+                self._store_memory(" ".join(texts), user_id)
+
+            if stop:
+                return
+
+    def _store_memory(self, text: str, user_id: str):
+        """Store a memory for a user (runs on the memory worker thread)"""
         try:
+            if self._memory_logging():
+                logger.info("Storing memory for user %s: %.100s...", user_id, text)
+
+            memory = self.get_memory()
             memory.add(data=text, user_id=user_id)
-            logger.info(f"Memory stored successfully for user {user_id}")
+            self._invalidate_search_cache(user_id)
+            logger.info("Memory stored successfully for user %s", user_id)
         except Exception as e:
-            logger.error(f"Failed to store memory in thread: {e}")
+            logger.error("Failed to store memory in thread: %s", e)
 
     async def _add_memory_context(self, all_messages: list, last_message: str, user_id: str):
         """Retrieve relevant memories and add to message context"""
         try:
-            memory = self.get_memory()
-            memories = memory.search(
-                query=last_message, 
-                user_id=user_id,
-                limit=self.valves.max_memories_retrieved
-            )
+            # Search on a worker thread so the event loop (and a queued store) keep running
+            memories = await asyncio.to_thread(self._search_memories, last_message, user_id)
 
             if memories:
                 # Filter memories by relevance threshold
@@ -197,15 +263,54 @@ class Pipeline:
                         "content": memory_context
                     })
 
-                    if self.valves.enable_memory_logging:
-                        logger.info(f"Added memory context for user {user_id}: {best_memory[:100]}...")
+                    if self._memory_logging():
+                        logger.info("Added memory context for user %s: %.100s...", user_id, best_memory)
 
         except Exception as e:
-            logger.error(f"Failed to retrieve memories: {e}")
+            logger.error("Failed to retrieve memories: %s", e)
+
+    def _search_memories(self, query: str, user_id: str):
+        """Search memories, reusing results for a repeated (user, message) pair"""
+        cache_size = self.valves.search_cache_size
+        key = (user_id, hashlib.blake2b(query.encode(), digest_size=16).digest())
+
+        version = None
+        if cache_size > 0:
+            with self._search_cache_lock:
+                memories = self._search_cache.get(key)
+                if memories is not None:
+                    self._search_cache.move_to_end(key)
+                    return memories
+                version = self._store_versions.get(user_id, 0)
+
+        memory = self.get_memory()
+        memories = memory.search(
+            query=query, 
+            user_id=user_id,
+            limit=self.valves.max_memories_retrieved
+        )
 
-    def init_mem_zero(self):
-        """Initialize Mem0 with configuration"""
-        config = {
+        if cache_size > 0:
+            with self._search_cache_lock:
+                # A store that finished meanwhile may have made these results stale
+                if self._store_versions.get(user_id, 0) != version:
+                    return memories
+                self._search_cache[key] = memories
+                while len(self._search_cache) > cache_size:
+                    self._search_cache.popitem(last=False)
+
+        return memories
+
+    def _invalidate_search_cache(self, user_id: str):
+        """Drop cached search results for a user whose memories changed"""
+        with self._search_cache_lock:
+            self._store_versions[user_id] = self._store_versions.get(user_id, 0) + 1
+            for key in [key for key in self._search_cache if key[0] == user_id]:
+                del self._search_cache[key]
+
+    def mem_zero_config(self) -> dict:
+        """Build the Mem0 configuration from the valves"""
+        return {
             "vector_store": {
                 "provider": "qdrant",
                 "config": {
@@ -233,5 +338,7 @@ class Pipeline:
             },
         }
 
+    def init_mem_zero(self, config: Optional[dict] = None):
+        """Initialize Mem0 with configuration"""
         logger.info("Initializing Mem0 with configuration")
-        return Memory.from_config(config)
+        return Memory.from_config(config or self.mem_zero_config())
@@ -5,14 +5,36 @@ date: 2024-10-04
 version: 2.0
 license: MIT
 description: A robust filter that processes user messages and stores them as long term memory using mem0, qdrant and ollama with comprehensive error handling
-requirements: pydantic, ollama, mem0ai
+requirements: pydantic, ollama, mem0ai, orjson
 """
 
 from typing import List, Optional
 from pydantic import BaseModel
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+import asyncio
+import hashlib
 import json
+import queue
 import threading
 import time
+import uuid
+
+# Prefer orjson for parsing request bodies, fall back to the stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Dedicated pool for memory searches, shared by all requests and separate from
+# the storage thread so searches never wait behind writes
+_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mem0-search")
+
+# Builds mem0 memory instances in the background, off the request path
+_INIT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mem0-init")
 
 class Pipeline:
     class Valves(BaseModel):
@@ -20,6 +42,8 @@ class Pipeline:
         priority: int = 0
 
         store_cycles: int = 3  # Number of messages before storing memory
+        max_chars_per_message: int = 2048  # Longer messages are truncated before storage
+        max_store_chars: int = 4096  # Cap on the combined text sent to the embedder per store
         mem_zero_user: str = "bailey"  # User ID for memory organization
 
         # Qdrant configuration
@@ -38,70 +62,128 @@ class Pipeline:
         ollama_embedder_model: str = "nomic-embed-text:latest"
         ollama_embedder_url: str = "http://host.docker.internal:11434"
 
+        # Store each message as its own memory with one batched embed call and one
+        # Qdrant upload, instead of memory.add (skips mem0's LLM fact extraction)
+        batch_embed_storage: bool = False
+
         # Feature flags
         enable_memory_storage: bool = True
         enable_memory_search: bool = True
         debug_mode: bool = True
 
+        # Caching of repeated messages (skips the embedder round-trip)
+        message_cache_size: int = 1024  # Entries per cache, 0 disables caching
+        cache_ttl_seconds: int = 300
+
     def __init__(self):
         self.type = "filter"
         self.name = "Memory Filter"
-        self.user_messages = []
-        self.thread = None
+        self._storage_q = queue.Queue(maxsize=64)  # Pending (memory, messages, user_id) storage jobs
+        self._storage_worker = None
         self.m = None  # Lazy initialization
+        self._init_future = None  # Background mem0 initialization, see get_memory()
+        self._ollama = None  # Ollama client for batched embeddings, created on first use
         self.memory_available = False
+        self._search_cache = OrderedDict()  # (user_id, message hash) -> (stored_at, memories)
+        self._recent_adds = OrderedDict()  # (user_id, text hash) -> (stored_at, True)
+        self._cache_lock = threading.RLock()  # Guards both caches, the storage worker updates them too
+        self._store_versions = {}  # user_id -> completed stores, so searches racing a store aren't cached
         self.valves = self.Valves(
             **{
                 "pipelines": ["*"],  # Connect to all pipelines
             }
         )
+        self.user_messages = deque(maxlen=self.valves.store_cycles)  # Oldest messages are evicted first
 
     async def on_startup(self):
         if self.valves.debug_mode:
             print(f"🚀 Starting mem0 memory filter pipeline")
+        # Start building memory now so the first message doesn't wait for it
+        if self._init_future is None:
+            self._init_future = _INIT_EXECUTOR.submit(self._build_memory)
+        self._start_storage_worker()
 
     async def on_shutdown(self):
         if self.valves.debug_mode:
             print(f"🛑 Shutting down mem0 memory filter pipeline")
+        # Give queued storage a chance to finish
+        if self._storage_worker and self._storage_worker.is_alive():
+            try:
+                self._storage_q.put(None, timeout=2)  # Sentinel: stop after draining
+            except queue.Full:
+                pass
+            await asyncio.to_thread(self._storage_worker.join, 10)
+        self._storage_worker = None
+
+    def _start_storage_worker(self):
+        """Start the long-lived thread that performs memory storage"""
+        if self._storage_worker and self._storage_worker.is_alive():
+            return
+        self._storage_worker = threading.Thread(target=self._storage_loop, name="mem0-store", daemon=True)
+        self._storage_worker.start()
+
+    def _storage_loop(self):
+        """Worker loop: coalesce queued storage jobs into short windows and store them"""
+        while True:
+            job = self._storage_q.get()
+            if job is None:
+                return
+
+            # Collect whatever else arrives within the window, across all users
+            jobs = [job]
+            stopping = False
+            deadline = time.monotonic() + 0.05
+            while len(jobs) < 64:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self._storage_q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                jobs.append(job)
+
+            self._store_jobs(jobs)
+            if stopping:
+                return
+
+    def _store_jobs(self, jobs: List[tuple]):
+        """Store a window of (memory, messages, user_id) jobs, batched into one upload when enabled"""
+        dbg = self.valves.debug_mode
+        if self.valves.batch_embed_storage:
+            memory = jobs[0][0]
+            items = [(message, user_id) for _, messages, user_id in jobs for message in messages]
+            try:
+                self._batch_store(memory, items)
+                for _, messages, user_id in jobs:
+                    self._mark_stored(" ".join(messages), user_id)
+                if dbg:
+                    users = len({user_id for _, _, user_id in jobs})
+                    print(f"✅ Stored {len(items)} memories for {users} user(s) in one batch")
+                return
+            except Exception as e:
+                if dbg:
+                    print(f"⚠️ Batched storage failed, falling back to memory.add: {str(e)}")
+
+        for memory, messages, user_id in jobs:
+            self._safe_memory_add(memory, messages, user_id)
 
     def get_memory(self):
-        """Lazy initialization of memory instance with robust error handling"""
+        """Return the memory instance once background initialization is done, else None"""
         if self.m is None and not hasattr(self, '_init_failed'):
-            try:
+            if self._init_future is None:
+                self._init_future = _INIT_EXECUTOR.submit(self._build_memory)
+
+            if not self._init_future.done():
                 if self.valves.debug_mode:
-                    print("🔄 Initializing mem0 memory...")
-                
-                from mem0 import Memory
-                
-                config = {
-                    "vector_store": {
-                        "provider": "qdrant",
-                        "config": {
-                            "collection_name": self.valves.vector_store_qdrant_name,
-                            "host": self.valves.vector_store_qdrant_url,
-                            "port": self.valves.vector_store_qdrant_port,
-                            "embedding_model_dims": self.valves.vector_store_qdrant_dims,
-                        },
-                    },
-                    "llm": {
-                        "provider": "ollama",
-                        "config": {
-                            "model": self.valves.ollama_llm_model,
-                            "temperature": self.valves.ollama_llm_temperature,
-                            "max_tokens": self.valves.ollama_llm_tokens,
-                            "ollama_base_url": self.valves.ollama_llm_url,
-                        },
-                    },
-                    "embedder": {
-                        "provider": "ollama",
-                        "config": {
-                            "model": self.valves.ollama_embedder_model,
-                            "ollama_base_url": self.valves.ollama_embedder_url,
-                        },
-                    },
-                }
-                
-                self.m = Memory.from_config(config)
+                    print("⏳ Memory still initializing, skipping memory for this message")
+                return None
+
+            try:
+                self.m = self._init_future.result()
                 self.memory_available = True
                 
                 if self.valves.debug_mode:
@@ -116,113 +198,190 @@ class Pipeline:
                 
         return self.m if self.memory_available else None
 
+    def _build_memory(self):
+        """Create the mem0 memory instance (runs on the init executor)"""
+        if self.valves.debug_mode:
+            print("🔄 Initializing mem0 memory...")
+        
+        from mem0 import Memory
+        
+        config = {
+            "vector_store": {
+                "provider": "qdrant",
+                "config": {
+                    "collection_name": self.valves.vector_store_qdrant_name,
+                    "host": self.valves.vector_store_qdrant_url,
+                    "port": self.valves.vector_store_qdrant_port,
+                    "embedding_model_dims": self.valves.vector_store_qdrant_dims,
+                },
+            },
+            "llm": {
+                "provider": "ollama",
+                "config": {
+                    "model": self.valves.ollama_llm_model,
+                    "temperature": self.valves.ollama_llm_temperature,
+                    "max_tokens": self.valves.ollama_llm_tokens,
+                    "ollama_base_url": self.valves.ollama_llm_url,
+                },
+            },
+            "embedder": {
+                "provider": "ollama",
+                "config": {
+                    "model": self.valves.ollama_embedder_model,
+                    "ollama_base_url": self.valves.ollama_embedder_url,
+                },
+            },
+        }
+        
+        return Memory.from_config(config)
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Process incoming messages with robust error handling"""
+        dbg = self.valves.debug_mode
         try:
-            if self.valves.debug_mode:
+            if dbg:
                 print(f"🔄 Processing message through mem0 pipeline")
 
             # Validate input
             if not isinstance(body, dict):
                 if isinstance(body, str):
                     try:
-                        body = json.loads(body)
+                        body = _json_loads(body)
                     except:
-                        if self.valves.debug_mode:
+                        if dbg:
                             print("❌ Invalid JSON body, skipping memory processing")
                         return body
                 else:
-                    if self.valves.debug_mode:
+                    if dbg:
                         print("❌ Invalid body type, skipping memory processing")
                     return body
 
             if "messages" not in body or not body["messages"]:
-                if self.valves.debug_mode:
+                if dbg:
                     print("❌ No messages found, skipping memory processing")
                 return body
 
             user_id = self.valves.mem_zero_user
             all_messages = body["messages"]
             
-            # Get the last user message
+            # Get the last user message; in Open WebUI it is almost always the last one
             last_user_message = None
-            for msg in reversed(all_messages):
-                if msg.get("role") == "user" and msg.get("content"):
-                    last_user_message = msg.get("content", "").strip()
-                    break
+            last = all_messages[-1]
+            if last.get("role") == "user" and last.get("content"):
+                last_user_message = last["content"].strip()
+            else:
+                for msg in reversed(all_messages):
+                    if msg.get("role") == "user" and msg.get("content"):
+                        last_user_message = msg.get("content", "").strip()
+                        break
             
             if not last_user_message:
-                if self.valves.debug_mode:
+                if dbg:
                     print("❌ No user message found, skipping memory processing")
                 return body
 
-            if self.valves.debug_mode:
+            if dbg:
                 print(f"📝 Processing user message: {last_user_message[:100]}...")
 
-            # Handle memory storage
+            # Handle memory storage and search concurrently; one failing doesn't cancel the other
+            handlers = []
             if self.valves.enable_memory_storage:
-                self._handle_memory_storage(last_user_message, user_id)
-
-            # Handle memory search
+                handlers.append(self._handle_memory_storage(last_user_message, user_id))
             if self.valves.enable_memory_search:
-                self._handle_memory_search(last_user_message, user_id, all_messages)
+                handlers.append(self._handle_memory_search(last_user_message, user_id, all_messages))
+            if handlers:
+                await asyncio.gather(*handlers, return_exceptions=True)
 
-            if self.valves.debug_mode:
+            if dbg:
                 print("✅ Memory processing completed")
                 
             return body
 
         except Exception as e:
-            if self.valves.debug_mode:
+            if dbg:
                 print(f"❌ Critical error in mem0 pipeline: {str(e)}")
             # Always return the original body to prevent breaking the chat
             return body
 
-    def _handle_memory_storage(self, message: str, user_id: str):
+    async def _handle_memory_storage(self, message: str, user_id: str):
         """Handle memory storage with error handling"""
+        dbg = self.valves.debug_mode
         try:
-            self.user_messages.append(message)
+            if self.user_messages.maxlen != self.valves.store_cycles:
+                self.user_messages = deque(self.user_messages, maxlen=self.valves.store_cycles)
+            self.user_messages.append(message[:self.valves.max_chars_per_message])
 
             if len(self.user_messages) >= self.valves.store_cycles:
                 memory = self.get_memory()
                 if memory:
-                    message_text = " ".join(self.user_messages)
-                    
-                    # Wait for previous thread if still running
-                    if self.thread and self.thread.is_alive():
-                        if self.valves.debug_mode:
-                            print("⏳ Waiting for previous memory storage...")
-                        self.thread.join(timeout=2.0)  # Short timeout
+                    messages = self._bounded_messages(self.user_messages, self.valves.max_store_chars)
+                    message_text = " ".join(messages)
 
-                    if self.valves.debug_mode:
+                    # Skip texts stored recently, they would only be embedded again
+                    if self._cache_get(self._recent_adds, self._message_key(message_text, user_id)):
+                        if dbg:
+                            print("♻️ Memory already stored recently, skipping")
+                        self.user_messages.clear()
+                        return
+                    
+                    if dbg:
                         print(f"💾 Storing memory: {message_text[:100]}...")
                     
-                    # Store memory in background thread
-                    self.thread = threading.Thread(
-                        target=self._safe_memory_add, 
-                        args=(memory, message_text, user_id)
-                    )
-                    self.thread.daemon = True  # Don't block shutdown
-                    self.thread.start()
+                    # Hand off to the storage worker; never wait on the request path
+                    self._start_storage_worker()
+                    try:
+                        self._storage_q.put_nowait((memory, messages, user_id))
+                    except queue.Full:
+                        if dbg:
+                            print("⚠️ Memory storage queue full, dropping these messages")
                 
                 self.user_messages.clear()
                 
         except Exception as e:
-            if self.valves.debug_mode:
+            if dbg:
                 print(f"❌ Error in memory storage: {str(e)}")
 
-    def _handle_memory_search(self, message: str, user_id: str, all_messages: list):
+    def _bounded_messages(self, messages, limit: int) -> List[str]:
+        """Return messages truncated so that joining them with spaces stays within limit characters"""
+        parts = []
+        total = 0
+        for message in messages:
+            separator = 1 if parts else 0
+            remaining = limit - total - separator
+            if remaining <= 0:
+                break
+            part = message[:remaining]
+            parts.append(part)
+            total += separator + len(part)
+        return parts
+
+    async def _handle_memory_search(self, message: str, user_id: str, all_messages: list):
         """Handle memory search with error handling"""
+        dbg = self.valves.debug_mode
         try:
             memory = self.get_memory()
             if not memory:
                 return
 
-            if self.valves.debug_mode:
-                print(f"🔍 Searching memories for: {message[:50]}...")
-            
-            # Simple timeout by limiting search complexity
-            memories = memory.search(message, user_id=user_id, limit=3)
+            search_key = self._message_key(message, user_id)
+            memories = self._cache_get(self._search_cache, search_key)
+            if memories is not None:
+                if dbg:
+                    print(f"♻️ Reusing cached memories for: {message[:50]}...")
+            else:
+                if dbg:
+                    print(f"🔍 Searching memories for: {message[:50]}...")
+
+                # Simple timeout by limiting search complexity; run off the event loop
+                version = self._store_versions.get(user_id, 0)
+                loop = asyncio.get_running_loop()
+                memories = await loop.run_in_executor(
+                    _SEARCH_EXECUTOR, partial(memory.search, message, user_id=user_id, limit=3)
+                )
+                # Don't cache results that a store finishing meanwhile may have made stale
+                with self._cache_lock:
+                    if self._store_versions.get(user_id, 0) == version:
+                        self._cache_put(self._search_cache, search_key, memories)
             
             if memories and len(memories) > 0:
                 # Get the best memory
@@ -236,7 +395,7 @@ class Pipeline:
                     fetched_memory = best_memory.memory
                 
                 if fetched_memory and len(fetched_memory.strip()) > 0:
-                    if self.valves.debug_mode:
+                    if dbg:
                         print(f"🧠 Found relevant memory: {fetched_memory[:100]}...")
                     
                     # Insert memory as system message
@@ -246,22 +405,114 @@ class Pipeline:
                     }
                     all_messages.insert(0, memory_message)
                 else:
-                    if self.valves.debug_mode:
+                    if dbg:
                         print("🔍 No relevant memories found")
             else:
-                if self.valves.debug_mode:
+                if dbg:
                     print("🔍 No memories returned from search")
                     
         except Exception as e:
-            if self.valves.debug_mode:
+            if dbg:
                 print(f"❌ Error searching memories: {str(e)}")
 
-    def _safe_memory_add(self, memory, message_text: str, user_id: str):
+    def _message_key(self, text: str, user_id: str) -> tuple:
+        """Content-addressed cache key: embedder model plus normalized text, per user"""
+        normalized = " ".join(text.lower().split())
+        digest = hashlib.blake2b(
+            f"{self.valves.ollama_embedder_model}\n{normalized}".encode(), digest_size=16
+        ).hexdigest()
+        return (user_id, digest)
+
+    def _cache_get(self, cache: OrderedDict, key: tuple):
+        """Return a cached value, or None if missing or older than cache_ttl_seconds"""
+        with self._cache_lock:
+            entry = cache.get(key)
+            if entry is None:
+                return None
+
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.valves.cache_ttl_seconds:
+                del cache[key]
+                return None
+
+            cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, cache: OrderedDict, key: tuple, value):
+        """Store a value, evicting the least recently used entries beyond message_cache_size"""
+        if self.valves.message_cache_size <= 0:
+            return
+
+        with self._cache_lock:
+            cache[key] = (time.monotonic(), value)
+            cache.move_to_end(key)
+            while len(cache) > self.valves.message_cache_size:
+                cache.popitem(last=False)
+
+    def _mark_stored(self, message_text: str, user_id: str):
+        """Record a completed store: remember the text and drop the user's now stale search results"""
+        with self._cache_lock:
+            self._cache_put(self._recent_adds, self._message_key(message_text, user_id), True)
+            self._store_versions[user_id] = self._store_versions.get(user_id, 0) + 1
+            for key in [key for key in self._search_cache if key[0] == user_id]:
+                del self._search_cache[key]
+
+    def _safe_memory_add(self, memory, messages: List[str], user_id: str):
         """Safely add memory in background thread"""
+        dbg = self.valves.debug_mode
         try:
+            message_text = " ".join(messages)
             memory.add(message_text, user_id=user_id)
-            if self.valves.debug_mode:
+            self._mark_stored(message_text, user_id)
+            if dbg:
                 print(f"✅ Memory stored successfully for user: {user_id}")
         except Exception as e:
-            if self.valves.debug_mode:
+            if dbg:
                 print(f"❌ Error in background memory storage: {str(e)}")
+
+    def _batch_store(self, memory, items: List[tuple]):
+        """Embed (text, user_id) items in one call and upload them to mem0's Qdrant collection"""
+        from qdrant_client.models import PointStruct
+
+        embeddings = self._embed_batch([text for text, _ in items])
+
+        # Same payload fields mem0 writes, so its user-scoped search finds these points
+        created_at = datetime.now(timezone.utc).isoformat()
+        points = [
+            PointStruct(
+                id=str(uuid.uuid4()),
+                vector=vector,
+                payload={
+                    "data": text,
+                    "hash": hashlib.md5(text.encode()).hexdigest(),
+                    "created_at": created_at,
+                    "user_id": user_id,
+                },
+            )
+            for (text, user_id), vector in zip(items, embeddings)
+        ]
+
+        vector_store = memory.vector_store
+        vector_store.client.upload_points(
+            collection_name=vector_store.collection_name,
+            points=points,
+            batch_size=64,
+        )
+
+    def _embed_batch(self, texts: List[str]) -> List[list]:
+        """Embed several texts with a single Ollama /api/embed request"""
+        if self._ollama is None:
+            from ollama import Client
+            self._ollama = Client(host=self.valves.ollama_embedder_url)
+
+        model = self.valves.ollama_embedder_model
+        try:
+            embeddings = self._ollama.embed(model=model, input=texts)["embeddings"]
+        except Exception:
+            embeddings = None
+
+        if not embeddings or len(embeddings) != len(texts):
+            # Older Ollama servers only have /api/embeddings, one text per request
+            embeddings = [self._ollama.embeddings(model=model, prompt=text)["embedding"] for text in texts]
+
+        return embeddings
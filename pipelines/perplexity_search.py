@@ -5,20 +5,49 @@ date: 2024-12-04
 version: 1.0
 license: MIT
 description: A pipeline that integrates Perplexity's web search API for real-time information retrieval
-requirements: pydantic, requests, openai
+requirements: pydantic, httpx[http2], openai, orjson
 """
 
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import json
-import requests
+import httpx
 import logging
 import re
 from datetime import datetime
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging (handlers are left to the host process)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Prefer orjson for parsing request and response bodies, fall back to the stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Question patterns that might benefit from search
+_QUESTION_PATTERNS = [
+    r'\bwhat\s+is\b',
+    r'\bwho\s+is\b',
+    r'\bwhen\s+did\b',
+    r'\bwhere\s+is\b',
+    r'\bhow\s+to\b',
+    r'\bwhy\s+does\b',
+    r'\blatest\b',
+    r'\brecent\b',
+    r'\bcurrent\b',
+    r'\bnews\b',
+    r'\btoday\b',
+    r'\b202[4-9]\b',  # Years 2024-2029
+]
+# Manual search triggers, only recognized at the start of a message
+_MANUAL_TRIGGERS = ("search:", "web:", "find:", "lookup:")
+# Manual search trigger followed by common conversational elements, removed in one pass
+_QUERY_PREFIX_RE = re.compile(
+    r'^(?:(?:search|web|find|lookup):\s*)?(?:(?:can you|could you|please|help me)\s+)?', re.IGNORECASE
+)
 
 class Pipeline:
     class Valves(BaseModel):
@@ -43,6 +72,7 @@ class Pipeline:
         max_tokens: int = 1000
         temperature: float = 0.2
         top_p: float = 0.9
+        streaming: bool = False  # Read the search answer over SSE; the filter still waits for all of it
         
         # Content Filtering
         search_domains: List[str] = []  # Empty = all domains
@@ -62,30 +92,46 @@ class Pipeline:
                 "pipelines": ["*"],  # Connect to all pipelines
             }
         )
-        logger.info(f"Initialized {self.name} pipeline")
+        self._http: Optional[httpx.AsyncClient] = None  # Shared keep-alive client, see _get_http_client()
+        self._trigger_keywords = None  # Keywords _trigger_re was compiled from
+        self._trigger_re = None
+        logger.info("Initialized %s pipeline", self.name)
 
     async def on_startup(self):
-        logger.info(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
+        self._get_http_client()
         # Test API connection
         if self.valves.perplexity_api_key:
             try:
                 await self._test_api_connection()
                 logger.info("Perplexity API connection successful")
             except Exception as e:
-                logger.warning(f"Perplexity API test failed: {e}")
+                logger.warning("Perplexity API test failed: %s", e)
         else:
             logger.warning("No Perplexity API key configured")
 
     async def on_shutdown(self):
-        logger.info(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Return the HTTP/2 client reused for all Perplexity requests"""
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30),
+            )
+        return self._http
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         """Process incoming messages and add web search context if needed"""
-        logger.info(f"Processing message through {__name__}")
+        logger.info("Processing message through %s", __name__)
 
         # Parse body if it's a string
         if isinstance(body, str):
-            body = json.loads(body)
+            body = _json_loads(body)
 
         all_messages = body.get("messages", [])
         if not all_messages:
@@ -103,7 +149,7 @@ class Pipeline:
                     await self._add_search_context(all_messages, search_results)
                     logger.info("Added web search context to conversation")
             except Exception as e:
-                logger.error(f"Search failed: {e}")
+                logger.error("Search failed: %s", e)
 
         return body
 
@@ -112,40 +158,24 @@ class Pipeline:
         if not self.valves.enable_auto_search and not self.valves.enable_manual_search:
             return False
 
-        message_lower = message.lower()
+        # Check for manual search triggers; only the prefix is lowercased
+        if self.valves.enable_manual_search and message[:7].lower().startswith(_MANUAL_TRIGGERS):
+            return True
 
-        # Check for manual search triggers
-        if self.valves.enable_manual_search:
-            manual_triggers = ["search:", "web:", "find:", "lookup:"]
-            if any(trigger in message_lower for trigger in manual_triggers):
-                return True
+        if not self.valves.enable_auto_search:
+            return False
 
-        # Check for automatic search triggers
-        if self.valves.enable_auto_search:
-            # Check for search keywords
-            if any(keyword in message_lower for keyword in self.valves.search_trigger_keywords):
-                return True
-            
-            # Check for question patterns that might benefit from search
-            question_patterns = [
-                r'\bwhat\s+is\b',
-                r'\bwho\s+is\b',
-                r'\bwhen\s+did\b',
-                r'\bwhere\s+is\b',
-                r'\bhow\s+to\b',
-                r'\bwhy\s+does\b',
-                r'\blatest\b',
-                r'\brecent\b',
-                r'\bcurrent\b',
-                r'\bnews\b',
-                r'\btoday\b',
-                r'\b202[4-9]\b',  # Years 2024-2029
-            ]
-            
-            if any(re.search(pattern, message_lower) for pattern in question_patterns):
-                return True
+        # Check for automatic search triggers (keywords and question patterns in one case-insensitive pass)
+        return self._get_trigger_re().search(message) is not None
 
-        return False
+    def _get_trigger_re(self) -> re.Pattern:
+        """Return the automatic trigger regex, recompiled only when the keyword valve changes"""
+        keywords = tuple(self.valves.search_trigger_keywords)
+        if self._trigger_re is None or keywords != self._trigger_keywords:
+            patterns = [re.escape(keyword) for keyword in keywords if keyword] + _QUESTION_PATTERNS
+            self._trigger_re = re.compile("|".join(patterns), re.IGNORECASE)
+            self._trigger_keywords = keywords
+        return self._trigger_re
 
     async def _perform_search(self, query: str) -> Optional[str]:
         """Perform web search using Perplexity API"""
@@ -183,40 +213,84 @@ class Pipeline:
             search_data = {k: v for k, v in search_data.items() if v is not None}
 
             # Make API request
-            response = requests.post(
-                f"{self.valves.perplexity_base_url}/chat/completions",
-                headers=headers,
-                json=search_data,
-                timeout=30
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                
-                # Extract citations if available
-                citations = result.get("citations", [])
-                
-                # Format the response
-                formatted_result = self._format_search_results(content, citations)
-                
-                logger.info(f"Search successful for query: {search_query[:50]}...")
-                return formatted_result
+            if self.valves.streaming:
+                result = await self._stream_search(headers, search_data)
             else:
-                logger.error(f"Search API error: {response.status_code} - {response.text}")
+                result = await self._request_search(headers, search_data)
+            if result is None:
                 return None
+            content, citations = result
+
+            # Format the response
+            formatted_result = self._format_search_results(content, citations)
+
+            logger.info("Search successful for query: %.50s...", search_query)
+            return formatted_result
 
         except Exception as e:
-            logger.error(f"Search request failed: {e}")
+            logger.error("Search request failed: %s", e)
+            return None
+
+    async def _request_search(self, headers: dict, search_data: dict) -> Optional[tuple]:
+        """Send the search request and return (content, citations) from the full response body"""
+        response = await self._get_http_client().post(
+            f"{self.valves.perplexity_base_url}/chat/completions",
+            headers=headers,
+            json=search_data,
+            timeout=30
+        )
+
+        if response.status_code != 200:
+            logger.error("Search API error: %s - %s", response.status_code, response.text)
             return None
 
+        result = _json_loads(response.content)
+        content = result["choices"][0]["message"]["content"]
+
+        # Extract citations if available
+        return content, result.get("citations", [])
+
+    async def _stream_search(self, headers: dict, search_data: dict) -> Optional[tuple]:
+        """Stream the search answer over SSE and return (content, citations) once it finishes"""
+        parts = []
+        citations = []
+
+        async with self._get_http_client().stream(
+            "POST",
+            f"{self.valves.perplexity_base_url}/chat/completions",
+            headers=headers,
+            json={**search_data, "stream": True},
+            timeout=30
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                logger.error("Search API error: %s - %s", response.status_code, response.text)
+                return None
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+
+                chunk = _json_loads(data)
+                # Citations come with the chunks (complete by the last one), keep the latest
+                citations = chunk.get("citations") or citations
+                choice = chunk["choices"][0] if chunk.get("choices") else {}
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    parts.append(content)
+                # Stop reading as soon as the answer is complete
+                if choice.get("finish_reason"):
+                    break
+
+        return "".join(parts), citations
+
     def _clean_search_query(self, query: str) -> str:
         """Clean and optimize the query for web search"""
-        # Remove manual search triggers
-        query = re.sub(r'^(search:|web:|find:|lookup:)\s*', '', query, flags=re.IGNORECASE)
-        
-        # Remove common conversational elements
-        query = re.sub(r'^(can you|could you|please|help me)\s+', '', query, flags=re.IGNORECASE)
+        # Remove manual search triggers and common conversational elements
+        query = _QUERY_PREFIX_RE.sub('', query, count=1)
         
         # Limit query length
         if len(query) > 200:
@@ -269,7 +343,7 @@ class Pipeline:
             "max_tokens": 10
         }
 
-        response = requests.post(
+        response = await self._get_http_client().post(
             f"{self.valves.perplexity_base_url}/chat/completions",
             headers=headers,
             json=test_data,
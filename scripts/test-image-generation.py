@@ -5,8 +5,74 @@ Test script for Open WebUI image generation functionality
 
 import requests
 import json
-import time
 import os
+import sys
+
+# Static output, written in one go rather than line by line
+_CONFIG_BANNER = """\
+
+📋 Configuration Checklist:
+1. ✅ Open WebUI is running with ENABLE_IMAGE_GENERATION=True
+2. 🔧 Next: Configure image generation in Admin Panel
+3. 🎯 Go to: http://localhost:3000
+4. 🔑 Navigate to: Admin Panel → Settings → Images
+
+🎨 Available Image Generation Options:
+┌─────────────────────────────────────────────────────────┐
+│ Option 1: OpenAI DALL-E (Recommended)                  │
+│ • Easy setup with API key                              │
+│ • High quality results                                 │
+│ • Cost: ~$0.02-0.04 per image                         │
+│                                                         │
+│ Option 2: Local Automatic1111                          │
+│ • Free after setup                                     │
+│ • Requires GPU with 8GB+ VRAM                         │
+│ • Full control and privacy                             │
+│                                                         │
+│ Option 3: Image Router                                 │
+│ • Access to multiple models                            │
+│ • Unified API for different providers                  │
+│ • Flexible pricing                                     │
+└─────────────────────────────────────────────────────────┘
+
+🚀 Quick Start Instructions:
+1. Open http://localhost:3000 in your browser
+2. Go to Admin Panel → Settings → Images
+3. Choose 'Open AI' as Image Generation Engine
+4. Enter your OpenAI API key
+5. Select DALL-E 3 model
+6. Save settings
+7. Toggle 'Image Generation' ON in a chat
+8. Type: 'A beautiful sunset over mountains'
+9. Click Send and watch the magic! ✨
+"""
+
+_EXAMPLE_PROMPTS = [
+    "A cute robot holding a paintbrush",
+    "A cyberpunk city at night with neon lights",
+    "A photorealistic cat wearing sunglasses",
+    "An abstract painting with flowing colors",
+    "A cozy coffee shop interior with warm lighting",
+    "A futuristic spaceship in deep space",
+    "A medieval castle on a hilltop",
+    "A tropical beach at sunset"
+]
+
+_PRO_TIPS = """\
+
+💡 Pro Tips:
+• Be specific about style: 'photorealistic', 'digital art', 'oil painting'
+• Include lighting: 'soft lighting', 'dramatic shadows', 'golden hour'
+• Specify quality: '4K', 'high resolution', 'detailed'
+• Add camera angles: 'close-up', 'wide angle', 'bird's eye view'
+"""
+
+_EXAMPLES_TEXT = (
+    "\n🎯 Example Prompts to Test:\n"
+    + "─" * 40 + "\n"
+    + "".join(f"{i:2d}. {prompt}\n" for i, prompt in enumerate(_EXAMPLE_PROMPTS, 1))
+    + _PRO_TIPS
+)
 
 def test_image_generation_config():
     """Test if image generation is properly configured in Open WebUI"""
@@ -14,63 +80,32 @@ def test_image_generation_config():
     print("🎨 Testing Open WebUI Image Generation Setup")
     print("=" * 50)
     
-    # Test Open WebUI health
-    try:
-        response = requests.get("http://localhost:3000/health", timeout=5)
-        if response.status_code == 200:
-            print("✅ Open WebUI is running and healthy")
-        else:
-            print("❌ Open WebUI health check failed")
+    # One session so both checks reuse the same connection
+    with requests.Session() as session:
+        # Test Open WebUI health
+        try:
+            response = session.get("http://localhost:3000/health", timeout=5)
+            if response.status_code == 200:
+                print("✅ Open WebUI is running and healthy")
+            else:
+                print("❌ Open WebUI health check failed")
+                return False
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Cannot connect to Open WebUI: {e}")
             return False
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Cannot connect to Open WebUI: {e}")
-        return False
-    
-    # Check if image generation is enabled
-    try:
-        # This endpoint might not exist, but we can check the main page
-        response = requests.get("http://localhost:3000", timeout=5)
-        if response.status_code == 200:
-            print("✅ Open WebUI web interface is accessible")
-        else:
-            print("❌ Open WebUI web interface not accessible")
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Cannot access Open WebUI interface: {e}")
-    
-    print("\n📋 Configuration Checklist:")
-    print("1. ✅ Open WebUI is running with ENABLE_IMAGE_GENERATION=True")
-    print("2. 🔧 Next: Configure image generation in Admin Panel")
-    print("3. 🎯 Go to: http://localhost:3000")
-    print("4. 🔑 Navigate to: Admin Panel → Settings → Images")
-    
-    print("\n🎨 Available Image Generation Options:")
-    print("┌─────────────────────────────────────────────────────────┐")
-    print("│ Option 1: OpenAI DALL-E (Recommended)                  │")
-    print("│ • Easy setup with API key                              │")
-    print("│ • High quality results                                 │")
-    print("│ • Cost: ~$0.02-0.04 per image                         │")
-    print("│                                                         │")
-    print("│ Option 2: Local Automatic1111                          │")
-    print("│ • Free after setup                                     │")
-    print("│ • Requires GPU with 8GB+ VRAM                         │")
-    print("│ • Full control and privacy                             │")
-    print("│                                                         │")
-    print("│ Option 3: Image Router                                 │")
-    print("│ • Access to multiple models                            │")
-    print("│ • Unified API for different providers                  │")
-    print("│ • Flexible pricing                                     │")
-    print("└─────────────────────────────────────────────────────────┘")
+
+        # Check if image generation is enabled
+        try:
+            # This endpoint might not exist, but we can check the main page
+            response = session.get("http://localhost:3000", timeout=5)
+            if response.status_code == 200:
+                print("✅ Open WebUI web interface is accessible")
+            else:
+                print("❌ Open WebUI web interface not accessible")
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Cannot access Open WebUI interface: {e}")
     
-    print("\n🚀 Quick Start Instructions:")
-    print("1. Open http://localhost:3000 in your browser")
-    print("2. Go to Admin Panel → Settings → Images")
-    print("3. Choose 'Open AI' as Image Generation Engine")
-    print("4. Enter your OpenAI API key")
-    print("5. Select DALL-E 3 model")
-    print("6. Save settings")
-    print("7. Toggle 'Image Generation' ON in a chat")
-    print("8. Type: 'A beautiful sunset over mountains'")
-    print("9. Click Send and watch the magic! ✨")
+    sys.stdout.write(_CONFIG_BANNER)
     
     return True
 
@@ -114,28 +149,7 @@ def test_openai_api_key():
 def show_example_prompts():
     """Show example prompts for testing"""
     
-    print("\n🎯 Example Prompts to Test:")
-    print("─" * 40)
-    
-    examples = [
-        "A cute robot holding a paintbrush",
-        "A cyberpunk city at night with neon lights",
-        "A photorealistic cat wearing sunglasses",
-        "An abstract painting with flowing colors",
-        "A cozy coffee shop interior with warm lighting",
-        "A futuristic spaceship in deep space",
-        "A medieval castle on a hilltop",
-        "A tropical beach at sunset"
-    ]
-    
-    for i, prompt in enumerate(examples, 1):
-        print(f"{i:2d}. {prompt}")
-    
-    print("\n💡 Pro Tips:")
-    print("• Be specific about style: 'photorealistic', 'digital art', 'oil painting'")
-    print("• Include lighting: 'soft lighting', 'dramatic shadows', 'golden hour'")
-    print("• Specify quality: '4K', 'high resolution', 'detailed'")
-    print("• Add camera angles: 'close-up', 'wide angle', 'bird's eye view'")
+    sys.stdout.write(_EXAMPLES_TEXT)
 
 if __name__ == "__main__":
     print("🎨 Open WebUI Image Generation Test Suite")